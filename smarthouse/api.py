@@ -1,35 +1,86 @@
+import logging
+import orjson
+from contextlib import asynccontextmanager
 import uvicorn
+from anyio import to_thread
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, ORJSONResponse, Response
 from smarthouse.persistence import SmartHouseRepository
 from pathlib import Path
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
 from typing import List, Optional
 from typing import Union, Dict
-from fastapi import HTTPException, Body, Query, APIRouter
+from fastapi import HTTPException, Body, Query, APIRouter, Request
+from fastapi.exceptions import RequestValidationError
 from smarthouse.domain import Sensor
 from smarthouse.domain import Actuator
+from smarthouse.domain import SmartHouse, Floor, Room
 
 
 import os
+import re
 def setup_database():
     project_dir = Path(__file__).parent.parent
     db_file = project_dir / "data" / "db.sql" # you have to adjust this if you have changed the file name of the database
     return SmartHouseRepository(str(db_file.absolute()))
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Filled in by load_smarthouse() when the app starts. This happens once per worker process,
+# so every worker has its own SQLite connection and its own in-memory copy of the house.
+repo: Optional[SmartHouseRepository] = None
+smarthouse: Optional[SmartHouse] = None
+FLOORS_BY_LEVEL: Dict[int, Floor] = {}
+ROOMS_BY_KEY: Dict[tuple[int, str], Room] = {}
+_CACHED: Dict[str, bytes] = {}
+_CACHED_FLOORS: Dict[int, bytes] = {}
+_CACHED_ROOMS: Dict[int, bytes] = {}
+_CACHED_ROOM: Dict[tuple[int, str], bytes] = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_smarthouse()
+    yield
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 router = APIRouter()
 
-repo = setup_database()
 
-smarthouse = repo.load_smarthouse_deep()
+# In production the static files are best served by a reverse proxy in front of uvicorn,
+# so they never reach Python at all, e.g. with nginx:
+#
+#   location /static/ { alias /app/www/; expires 1h; }
+#   location ~ "^/static/(.+\.[0-9a-f]{8,}\.\w+)$" { alias /app/www/$1; expires 1y; add_header Cache-Control immutable; }
+#
+# When they are served by the app itself, only fingerprinted files (app.3f2a9c1b.js) are cached
+# as immutable, since their name changes with their content. Other assets keep their name across
+# edits, so they get a short max-age and are then revalidated through ETag/Last-Modified.
+# HTML pages are always revalidated.
+_FINGERPRINTED = re.compile(r"\.[0-9a-f]{8,}\.[^./]+$")
+
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        path = str(full_path)
+        if path.endswith(".html"):
+            response.headers["Cache-Control"] = "no-cache"
+        elif _FINGERPRINTED.search(path):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
+
 
 if not (Path.cwd() / "www").exists():
     os.chdir(Path.cwd().parent)
 if (Path.cwd() / "www").exists():
     # http://localhost:8000/welcome/index.html
-    app.mount("/static", StaticFiles(directory="www"), name="static")
+    app.mount("/static", CachedStaticFiles(directory="www"), name="static")
 
 
 # http://localhost:8000/ -> welcome page
@@ -46,34 +97,35 @@ def hello(name: str = "world"):
 
 # Starting point ...
 
-@app.get("/smarthouse")
-def get_smarthouse_info() -> dict[str, int | float]:
+@app.get("/smarthouse", response_model=Dict[str, Union[int, float]])
+def get_smarthouse_info():
     """
     This endpoint returns an object that provides information
     about the general structure of the smarthouse.
     """
-    return {
-        "no_rooms": len(smarthouse.get_rooms()),
-        "no_floors": len(smarthouse.get_floors()),
-        "registered_devices": len(smarthouse.get_devices()),
-        "area": smarthouse.get_area()
-    }
+    return Response(content=_CACHED["smarthouse"], media_type="application/json")
 
 # TODO: implement the remaining HTTP endpoints as requested in
 # https://github.com/selabhvl/ing301-projectpartC-startcode?tab=readme-ov-file#oppgavebeskrivelse
 # here ...
 
-class FloorModel(BaseModel):
+class FrozenModel(BaseModel):
+    # Response models are never changed after construction, so they are frozen,
+    # and unknown fields are rejected instead of silently ignored.
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+
+class FloorModel(FrozenModel):
     level: int
     rooms: Optional[List[str]] = []  # returnerer kun liste med floors og romnavn tilhørende floors
 
 
-class RoomModel(BaseModel):
+class RoomModel(FrozenModel):
     room_name: str
     room_size: float
     devices: Optional[List[str]] = []
 
-class DeviceModel(BaseModel):
+class DeviceModel(FrozenModel):
     id: str
     model_name: str
     device_type: str
@@ -86,12 +138,12 @@ class SensorModel(DeviceModel):
 class ActuatorModel(DeviceModel):
     state: Union[bool, float, None]
 
-class MeasurementModel(BaseModel):
+class MeasurementModel(FrozenModel):
     timestamp: str
     value: float
     unit: str
 
-class CurrentSensorMeasurement(BaseModel):
+class CurrentSensorMeasurement(FrozenModel):
     timestamp: str
     value: float
     unit: str
@@ -104,109 +156,184 @@ class ActuatorStateModel(BaseModel):
     state: bool
 
 
+def _parse_new_measurement(raw: bytes) -> NewSensorMeasurement:
+    """
+    Validates a NewSensorMeasurement body straight from the raw bytes in pydantic-core, with the
+    same rules as a pydantic body parameter. Errors are reported in FastAPI's 422 format.
+    """
+    try:
+        return NewSensorMeasurement.model_validate_json(raw)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()])
+
+
+# Serializers are built once at import time and reused, instead of compiling a new one per call
+FLOOR_ADAPTER = TypeAdapter(FloorModel)
+FLOORS_LIST_ADAPTER = TypeAdapter(List[FloorModel])
+ROOM_ADAPTER = TypeAdapter(RoomModel)
+ROOMS_LIST_ADAPTER = TypeAdapter(List[RoomModel])
+DEVICES_LIST_ADAPTER = TypeAdapter(List[DeviceModel])
+
+def _floor_model(floor) -> FloorModel:
+    return FloorModel(level=floor.level, rooms=[room.room_name for room in floor.rooms])
+
+
+def _room_model(room) -> RoomModel:
+    return RoomModel(room_name=room.room_name, room_size=room.room_size, devices=[device.id for device in room.devices])
+
+
+def load_smarthouse():
+    global repo, smarthouse, FLOORS_BY_LEVEL, ROOMS_BY_KEY, _CACHED, _CACHED_FLOORS, _CACHED_ROOMS, _CACHED_ROOM
+    repo = setup_database()
+    # Safe to run from every worker at once, the schema is only changed by the first one
+    repo.migrate()
+    smarthouse = repo.load_smarthouse_deep()
+
+    # Lookup indexes for the per-id endpoints, built once since the topology is fixed after loading
+    FLOORS_BY_LEVEL = {floor.level: floor for floor in smarthouse.get_floors()}
+    ROOMS_BY_KEY = {(floor.level, room.room_name): room for floor in smarthouse.get_floors() for room in floor.rooms}
+
+    # The topology of the house does not change after loading, so the JSON for the
+    # topology endpoints is encoded once here and served as raw bytes on every request.
+    _CACHED = {
+        "smarthouse": orjson.dumps({
+            "no_rooms": len(smarthouse.get_rooms()),
+            "no_floors": len(smarthouse.get_floors()),
+            "registered_devices": len(smarthouse.get_devices()),
+            "area": smarthouse.get_area()
+        }),
+        "floors": FLOORS_LIST_ADAPTER.dump_json([_floor_model(floor) for floor in smarthouse.get_floors()]),
+        "devices": DEVICES_LIST_ADAPTER.dump_json([
+            DeviceModel(id=device.id, model_name=device.model_name, device_type=device.get_device_type(), supplier=device.supplier)
+            for device in smarthouse.get_devices()]),
+    }
+    _CACHED_FLOORS = {
+        level: FLOOR_ADAPTER.dump_json(_floor_model(floor)) for level, floor in FLOORS_BY_LEVEL.items()
+    }
+    _CACHED_ROOMS = {
+        level: ROOMS_LIST_ADAPTER.dump_json([_room_model(room) for room in floor.rooms])
+        for level, floor in FLOORS_BY_LEVEL.items()
+    }
+    _CACHED_ROOM = {key: ROOM_ADAPTER.dump_json(_room_model(room)) for key, room in ROOMS_BY_KEY.items()}
+
+
+# The response models are kept for the OpenAPI docs only: the endpoints return pre-encoded bytes
+# or an ORJSONResponse directly, so FastAPI skips jsonable_encoder and response validation.
+
 @app.get("/smarthouse/floor", response_model=List[FloorModel])
 def get_floors():
-    floors = smarthouse.get_floors()
-    print(f"Floors in the smarthouse: {floors}")
-    return [FloorModel(level=floor.level, rooms=[room.room_name for room in floor.rooms]) for floor in floors]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Floors in the smarthouse: %s", list(FLOORS_BY_LEVEL))
+    return Response(content=_CACHED["floors"], media_type="application/json")
 
 @app.get("/smarthouse/floor/{fid}", response_model=FloorModel)
 def get_floor(fid: int):
-    print(f"Requested floor ID: {fid}")
-    floors = smarthouse.get_floors()
-    print(f"Available floors: {[floor.level for floor in floors]}")
-    floor = next((f for f in floors if f.level == fid), None)
-    if not floor:
+    content = _CACHED_FLOORS.get(fid)
+    if content is None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Requested floor %s, available floors: %s", fid, list(FLOORS_BY_LEVEL))
         raise HTTPException(status_code=404, detail="Floor not found")
-    print(f"Returning floor: {floor.level} with rooms: {[room.room_name for room in floor.rooms]}")
-    return FloorModel(level=floor.level, rooms=[room.room_name for room in floor.rooms])
+    return Response(content=content, media_type="application/json")
 
 @app.get("/smarthouse/floor/{fid}/room", response_model=List[RoomModel])
 def get_rooms(fid: int):
-    floor = next((f for f in smarthouse.get_floors() if f.level == fid), None)
-    if not floor:
+    content = _CACHED_ROOMS.get(fid)
+    if content is None:
         raise HTTPException(status_code=404, detail="Floor not found")
-    return [RoomModel(room_name=room.room_name, room_size=room.room_size, devices=[device.id for device in room.devices]) for room in floor.rooms]
+    return Response(content=content, media_type="application/json")
 
 #Informasjon på et spesifikt rom
 @app.get("/smarthouse/floor/{fid}/room/{rid}", response_model=RoomModel)
 def get_room(fid: int, rid: str):
-    floor = next((f for f in smarthouse.get_floors() if f.level == fid), None)
-    if not floor:
+    if fid not in FLOORS_BY_LEVEL:
         raise HTTPException(status_code=404, detail="Floor not found")
-    room = next((r for r in floor.rooms if r.room_name == rid), None)
-    if not room:
+    content = _CACHED_ROOM.get((fid, rid))
+    if content is None:
         raise HTTPException(status_code=404, detail="Room not found")
-    return RoomModel(room_name=room.room_name, room_size=room.room_size, devices=[device.id for device in room.devices])
+    return Response(content=content, media_type="application/json")
 
 # Informasjon på alle devices
 @app.get("/smarthouse/device", response_model=List[DeviceModel])
 def get_devices():
-    return [DeviceModel(id=device.id, model_name=device.model_name, device_type=device.get_device_type(), supplier=device.supplier) for device in smarthouse.get_devices()]
+    return Response(content=_CACHED["devices"], media_type="application/json")
 
 #Hente info på device
 @app.get("/smarthouse/device/{uuid}", response_model=Union[SensorModel, ActuatorModel])
-def get_device(uuid: str):
+async def get_device(uuid: str):
     device = smarthouse.get_device_by_id(uuid)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     if device.is_sensor():
-        return SensorModel(id=device.id, model_name=device.model_name, device_type=device.get_device_type(), supplier=device.supplier, unit=device.unit)
+        return ORJSONResponse({"id": device.id, "model_name": device.model_name, "device_type": device.get_device_type(), "supplier": device.supplier, "unit": device.unit, "last_measurement": None})
     elif device.is_actuator():
-        return ActuatorModel(id=device.id, model_name=device.model_name, device_type=device.get_device_type(), supplier=device.supplier, state=device.state)
+        return ORJSONResponse({"id": device.id, "model_name": device.model_name, "device_type": device.get_device_type(), "supplier": device.supplier, "state": device.state})
     else:
         raise HTTPException(status_code=400, detail="Device type unknown")
 
+# Devices are looked up in the in-memory smarthouse. The repository calls below block on
+# SQLite, so they are handed to a worker thread while the event loop keeps serving other requests.
+
+def _get_sensor(uuid: str) -> Sensor:
+    # Actuators with a built-in sensor (the heat pump) are not served by the sensor endpoints,
+    # matching the devices the repository lookup used to return for them.
+    sensor = smarthouse.get_device_by_id(uuid)
+    if not isinstance(sensor, Sensor) or isinstance(sensor, Actuator):
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    return sensor
+
 #Hente nåværende måling for sensor
 @app.get("/smarthouse/sensor/{uuid}/current")
-def get_current_sensor_measurement(uuid: str):
-    sensor = repo.get_device_by_id(uuid)
-    if not isinstance(sensor, Sensor):
-        raise HTTPException(status_code=404, detail="Sensor not found")
-    latest_reading = repo.get_latest_reading(sensor)
+async def get_current_sensor_measurement(uuid: str):
+    sensor = _get_sensor(uuid)
+    latest_reading = await to_thread.run_sync(repo.get_latest_reading, sensor)
     if not latest_reading:
         raise HTTPException(status_code=404, detail="Latest reading not found")
     return latest_reading
 
 #Legge til ny måling for sensor
-@app.post("/smarthouse/sensor/{uuid}/current")
-def add_measurement_for_sensor(uuid: str, measurement: NewSensorMeasurement):
-    sensor = repo.get_device_by_id(uuid)
-    if sensor is None or not isinstance(sensor, Sensor):
-        raise HTTPException(status_code=404, detail="Sensor not found")
-
-    repo.add_measurement_to_sensor(sensor.id, measurement)
+# Hot ingest path: the raw body is validated in one pydantic-core call, skipping FastAPI's
+# body handling (JSON decoding in Python and field resolution). The schema is still published in the docs.
+@app.post("/smarthouse/sensor/{uuid}/current", openapi_extra={"requestBody": {
+    "required": True,
+    "content": {"application/json": {"schema": NewSensorMeasurement.model_json_schema()}},
+}})
+async def add_measurement_for_sensor(uuid: str, request: Request):
+    measurement = _parse_new_measurement(await request.body())
+
+    sensor = _get_sensor(uuid)
+
+    await to_thread.run_sync(repo.add_measurement_to_sensor, sensor.id, measurement.value, measurement.unit)
     return {"message": "Measurement added successfully"}
 
-#Hente siste måling fra sensor
-@app.get("/smarthouse/sensor/{uuid}/values", response_model=List[CurrentSensorMeasurement])
-def get_latest_sensor_measurements(uuid: str):
-    sensor = repo.get_device_by_id(uuid)
-    if not sensor or not isinstance(sensor, Sensor):
-        raise HTTPException(status_code=404, detail="Sensor not found")
+#Legge til flere målinger for sensor på en gang
+@app.post("/smarthouse/sensor/{uuid}/batch")
+async def add_measurements_for_sensor(uuid: str, measurements: List[NewSensorMeasurement]):
+    sensor = _get_sensor(uuid)
+
+    await to_thread.run_sync(repo.add_measurements_to_sensor, sensor.id, measurements)
+    return {"message": f"{len(measurements)} measurements added successfully"}
 
-    latest_measurement = repo.get_latest_reading(sensor)
-    if not latest_measurement:
-        return []
+#Hente de siste n målingene fra sensor, nyeste først
+@app.get("/smarthouse/sensor/{uuid}/values", response_model=List[CurrentSensorMeasurement])
+async def get_latest_sensor_measurements(uuid: str, n: int = Query(100, ge=1, le=10000)):
+    sensor = _get_sensor(uuid)
 
-    return [CurrentSensorMeasurement(timestamp=latest_measurement.timestamp, value=latest_measurement.value,
-                                     unit=latest_measurement.unit)]
+    measurements = await to_thread.run_sync(repo.get_latest_readings, sensor, n)
+    return ORJSONResponse([{"timestamp": m.timestamp, "value": m.value, "unit": m.unit} for m in measurements])
 
 # slette eldste måling for sensor
 
 @app.delete("/smarthouse/sensor/{uuid}/oldest")
-def delete_oldest_measurement_for_sensor(uuid: str):
-    sensor = repo.get_device_by_id(uuid)
-    if not sensor or not isinstance(sensor, Sensor):
-        raise HTTPException(status_code=404, detail="Sensor not found")
+async def delete_oldest_measurement_for_sensor(uuid: str):
+    sensor = _get_sensor(uuid)
 
-    repo.delete_oldest_measurement(sensor.id)
+    await to_thread.run_sync(repo.delete_oldest_measurement, sensor.id)
     return {"message": "Oldest measurement deleted successfully"}
 
 #Hente tilstand aktuator
 @app.get("/smarthouse/actuator/{uuid}/current")
-def get_current_actuator_state(uuid: str):
-    actuator_state = repo.get_actuator_state(uuid)
+async def get_current_actuator_state(uuid: str):
+    actuator_state = await to_thread.run_sync(repo.get_actuator_state, uuid)
     if actuator_state is None:
         raise HTTPException(status_code=404, detail="Actuator not found")
     return {"state": actuator_state}
@@ -215,16 +342,25 @@ def get_current_actuator_state(uuid: str):
 # oppdatere tilstand for en aktuator
 
 @app.post("/smarthouse/actuator/{uuid}/current")
-def update_actuator_state(uuid: str, state_model: ActuatorStateModel = Body(...)):
-    actuator = repo.get_device_by_id(uuid)
+async def update_actuator_state(uuid: str, state_model: ActuatorStateModel = Body(...)):
+    actuator = smarthouse.get_device_by_id(uuid)
     if not actuator:
         raise HTTPException(status_code=404, detail="Actuator not found")
 
-    repo.update_actuator_state(actuator, state_model.state)
+    await to_thread.run_sync(repo.update_actuator_state, actuator, state_model.state)
     return {"message": "Actuator state updated successfully"}
 
 
+# Each worker is a separate process with its own GIL, so serialization scales with the number of cores.
+# In production the app can also be run under gunicorn:
+#
+#   gunicorn smarthouse.api:app -k uvicorn.workers.UvicornWorker -w $((2 * $(nproc) + 1)) --bind 0.0.0.0:8000
+#
 if __name__ == '__main__':
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # loop/http stay on "auto": uvicorn picks uvloop and httptools when they are installed
+    # (see Requirements.txt) and falls back to asyncio and h11 otherwise.
+    # The app is passed as an import string since uvicorn needs that to spawn several workers.
+    uvicorn.run("smarthouse.api:app", host="127.0.0.1", port=8000,
+                workers=max(2, os.cpu_count() or 1), access_log=False, log_level="info")
 
 
@@ -1,6 +1,6 @@
 from datetime import datetime
 from random import random
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 from abc import abstractmethod
 from pydantic import BaseModel
 
@@ -123,6 +123,7 @@ class SmartHouse:
 
     def __init__(self) -> None:
         self.floors: List[Floor] = []
+        self._devices_by_id: Dict[str, Device] = {}
 
     def register_floor(self, level: int) -> Floor:
         """
@@ -179,6 +180,7 @@ class SmartHouse:
             old_room.devices.remove(device)
         room.devices.append(device)
         device.room = room
+        self._devices_by_id[device.id] = device
 
     def get_devices(self) -> List[Device]:
         """This method retrieves a list of all devices in the house"""
@@ -191,8 +193,5 @@ class SmartHouse:
         """
         This method retrieves a device object via its id.
         """
-        for d in self.get_devices():
-            if d.id == device_id:
-                return d
-        return None
+        return self._devices_by_id.get(device_id)
 
@@ -1,5 +1,5 @@
 import sqlite3
-from typing import Optional
+from typing import List, Optional
 from smarthouse.domain import Measurement
 from smarthouse.domain import SmartHouse, Sensor, Actuator, ActuatorWithSensor
 from .domain import NewSensorMeasurement
@@ -16,7 +16,74 @@ class SmartHouseRepository:
 
     def __init__(self, file: str) -> None:
         self.file = file
-        self.conn = sqlite3.connect(file, check_same_thread=False)
+        self.conn = self._connect()
+        # Opening a repository never changes the database file; the derived columns are only
+        # used once migrate() has been run on it.
+        self._has_time_columns = self._measurement_columns() >= {"hour", "day"}
+
+    def _measurement_columns(self) -> set:
+        return {row[1] for row in self.conn.execute("PRAGMA table_info(measurements)")}
+
+    def migrate(self) -> None:
+        """
+        Brings an existing database up to the schema the queries below rely on. This is a one-time
+        setup step (the API runs it at startup) and is not done when a repository is created.
+        Measurements get a precomputed `hour` and `day`, so the statistics do not parse `ts` for every row.
+        Every step is idempotent and runs under a write lock, so several processes may call this at once.
+        WAL mode lets readers proceed while a write is in progress; it is persistent and creates
+        `-wal`/`-shm` files next to the database, which are merged back when the last connection closes.
+        """
+        self.conn.commit()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = self._measurement_columns()
+            for column, column_type in (("hour", "INTEGER"), ("day", "TEXT")):
+                if column not in columns:
+                    try:
+                        self.conn.execute(f"ALTER TABLE measurements ADD COLUMN {column} {column_type}")
+                    except sqlite3.OperationalError as e:
+                        if "duplicate column" not in str(e):
+                            raise
+            self.conn.execute("UPDATE measurements SET hour = CAST(strftime('%H', ts) AS INTEGER), day = date(ts) "
+                              "WHERE day IS NULL")
+            # The repository fills hour/day in its INSERTs; the trigger only covers rows written by other tools
+            self.conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS measurements_hour_day AFTER INSERT ON measurements
+                WHEN NEW.day IS NULL
+                BEGIN
+                    UPDATE measurements SET hour = CAST(strftime('%H', NEW.ts) AS INTEGER), day = date(NEW.ts)
+                    WHERE rowid = NEW.rowid;
+                END
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_device_ts ON measurements(device, ts)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_day_hour ON measurements(day, hour)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_devices_room ON devices(room)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_rooms_name ON rooms(name)")
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self._has_time_columns = True
+
+    def _insert_measurement_sql(self) -> str:
+        if self._has_time_columns:
+            return ("INSERT INTO measurements (device, value, unit, ts, hour, day) "
+                    "VALUES (?, ?, ?, datetime('now'), CAST(strftime('%H', 'now') AS INTEGER), date('now'))")
+        return "INSERT INTO measurements (device, value, unit, ts) VALUES (?, ?, ?, datetime('now'))"
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens a connection to the database file. The database file is memory mapped so reads are
+        served from the page cache, and the larger statement cache keeps the compiled form of every
+        parameterized query around. These settings only last for the connection; WAL mode is stored
+        in the file itself and is therefore switched on by migrate().
+        """
+        conn = sqlite3.connect(self.file, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
 
 
     def __del__(self):
@@ -35,13 +102,11 @@ class SmartHouseRepository:
     def reconnect(self):
         if self.conn:
             self.conn.close()
-        self.conn = sqlite3.connect(self.file, check_same_thread=False)
+        self.conn = self._connect()
 
     def get_device_by_id(self, device_id: str):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, room, kind, category, supplier, product FROM devices WHERE id = ?", (device_id,))
-        row = cursor.fetchone()
-        cursor.close()
+        row = self.conn.execute("SELECT id, room, kind, category, supplier, product FROM devices WHERE id = ?",
+                                (device_id,)).fetchone()
         if row:
             device_id, room_id, kind, category, supplier, product = row
             if category == 'sensor':
@@ -50,12 +115,18 @@ class SmartHouseRepository:
                 return Actuator(id=device_id, model_name=product, supplier=supplier, device_type=kind)
         return None
 
-    def add_measurement_to_sensor(self, sensor_id: str, measurement: NewSensorMeasurement):
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO measurements (device, value, unit, ts) VALUES (?, ?, ?, datetime('now'))",
-                       (sensor_id, measurement.value, measurement.unit))
-        self.conn.commit()
-        cursor.close()
+    def add_measurement_to_sensor(self, sensor_id: str, value: float, unit: str):
+        with self.conn:
+            self.conn.execute(self._insert_measurement_sql(), (sensor_id, value, unit))
+
+    def add_measurements_to_sensor(self, sensor_id: str, measurements: List[NewSensorMeasurement]):
+        """
+        Inserts several measurements for the given sensor in a single transaction,
+        so the whole batch is committed (and synced to disk) only once.
+        """
+        with self.conn:
+            self.conn.executemany(self._insert_measurement_sql(),
+                                  [(sensor_id, measurement.value, measurement.unit) for measurement in measurements])
 
     def delete_oldest_measurement(self, sensor_id: str):
         """
@@ -70,10 +141,8 @@ class SmartHouseRepository:
           LIMIT 1
         );
         """
-        cursor = self.conn.cursor()
-        cursor.execute(delete_sql, (sensor_id,))
-        self.conn.commit()
-        cursor.close()
+        with self.conn:
+            self.conn.execute(delete_sql, (sensor_id,))
 
 
     def load_smarthouse_deep(self):
@@ -102,7 +171,9 @@ class SmartHouseRepository:
             room.db_id = int(room_tuple[0])
             room_dict[room_tuple[0]] = room
 
-        cursor.execute('SELECT id, room, kind, category, supplier, product from devices;')
+        # Actuator states are joined into the device query, so they are set while the devices are created
+        cursor.execute('SELECT d.id, d.room, d.kind, d.category, d.supplier, d.product, s.device, s.state '
+                       'FROM devices d LEFT JOIN states s ON s.device = d.id;')
         device_tuples = cursor.fetchall()
         for device_tuple in device_tuples:
             room = room_dict[device_tuple[1]]
@@ -111,18 +182,11 @@ class SmartHouseRepository:
                 result.register_device(room, Sensor(device_tuple[0], device_tuple[5], device_tuple[4], device_tuple[2]))
             elif category == 'actuator':
                 if device_tuple[2] == 'Heat Pump':
-                    result.register_device(room, ActuatorWithSensor(device_tuple[0], device_tuple[5], device_tuple[4],
-                                                                    device_tuple[2]))
+                    dev = ActuatorWithSensor(device_tuple[0], device_tuple[5], device_tuple[4], device_tuple[2])
                 else:
-                    result.register_device(room,
-                                           Actuator(device_tuple[0], device_tuple[5], device_tuple[4], device_tuple[2]))
-
-        for dev in result.get_devices():
-            if isinstance(dev, Actuator):
-                cursor.execute(f"SELECT state FROM states where device = '{dev.id}';")
-                state_result = cursor.fetchone()
-                if state_result is not None:
-                    state = state_result[0]
+                    dev = Actuator(device_tuple[0], device_tuple[5], device_tuple[4], device_tuple[2])
+                if device_tuple[6] is not None:
+                    state = device_tuple[7]
                     if state is None:
                         dev.turn_off()
                     elif float(state) == 1.0:
@@ -132,6 +196,7 @@ class SmartHouseRepository:
                 else:
                     # Handle case where no state is found for the device
                     print(f"No state found for device {dev.id}")
+                result.register_device(room, dev)
 
         cursor.close()
         return result
@@ -142,15 +207,10 @@ class SmartHouseRepository:
         Returns None if the given object has no sensor readings.
         """
         # TODO: After loading the smarthouse, continue here
-        # Kobler til database
-        cursor = self.cursor()
-
         # Henter siste måling
-        cursor.execute("SELECT value, unit, ts FROM measurements WHERE device = ? ORDER BY ts DESC LIMIT 1", (sensor.id,))
-        latest_reading = cursor.fetchone()
-
-        # Lukker cursor
-        cursor.close()
+        latest_reading = self.conn.execute(
+            "SELECT value, unit, ts FROM measurements WHERE device = ? ORDER BY ts DESC, rowid DESC LIMIT 1", (sensor.id,)
+        ).fetchone()
 
         # finner måling og returnerer målingen
         if latest_reading:
@@ -159,20 +219,25 @@ class SmartHouseRepository:
 
         return None
 
+    def get_latest_readings(self, sensor, n: int) -> List[Measurement]:
+        """
+        Retrieves up to n of the most recent readings for the given sensor, newest first.
+        Returns an empty list if the sensor has no readings.
+        """
+        rows = self.conn.execute(
+            "SELECT value, unit, ts FROM measurements WHERE device = ? ORDER BY ts DESC, rowid DESC LIMIT ?", (sensor.id, n)
+        ).fetchall()
+        return [Measurement(timestamp, float(value), unit) for value, unit, timestamp in rows]
+
     def update_actuator_state(self, actuator, new_state: bool):
         query = "UPDATE devices SET state = ? WHERE id = ?"
         params = (1 if new_state else 0, actuator.id)
-        c = self.cursor()
-        c.execute(query, params)
-        self.conn.commit()
-        c.close()
+        with self.conn:
+            self.conn.execute(query, params)
 
     def get_actuator_state(self, actuator_id: str) -> Optional[bool]:
         query = "SELECT state FROM devices WHERE id = ?"
-        cursor = self.conn.cursor()
-        cursor.execute(query, (actuator_id,))
-        row = cursor.fetchone()
-        cursor.close()
+        row = self.conn.execute(query, (actuator_id,)).fetchone()
         if row is not None:
             return bool(row[0])
         return None
@@ -190,8 +255,6 @@ class SmartHouseRepository:
         """
         # TODO: This and the following statistic method are a bit more challenging. Try to design the respective 
         #       SQL statements first in a SQL editor like Dbeaver and then copy it over here.
-        avg_temperatures = {} #oppretter en dict for avg temp
-
         # SQL kode for å hente gj snitt temp per dag for et gitt rom
         sql_query = """
             SELECT strftime('%Y-%m-%d', m.ts) AS date, AVG(m.value) AS avg_temperature
@@ -203,7 +266,8 @@ class SmartHouseRepository:
 
         params = [room.room_name]
 
-        # justerer sql koden etter dato som skal hentes fra i test
+        # justerer sql koden etter dato som skal hentes fra i test. Filteret sammenligner ts direkte
+        # (ISO-strenger sorteres som datoer), slik at indeksen på (device, ts) kan brukes.
         if from_date:
             sql_query += " AND m.ts >= ?"
             params.append(from_date)
@@ -213,15 +277,8 @@ class SmartHouseRepository:
 
         sql_query += " GROUP BY strftime('%Y-%m-%d', m.ts)"
 
-        # Executer sql koden
-        cursor = self.conn.cursor()
-        cursor.execute(sql_query, params)
-        rows = cursor.fetchall()
-
-        # fyller ut ordbok
-        for row in rows:
-            date, avg_temp = row
-            avg_temperatures[date] = avg_temp
+        # Executer sql koden, radene er allerede (dato, gj snitt temp) og blir direkte til en ordbok
+        avg_temperatures = dict(self.conn.execute(sql_query, params).fetchall())
 
         return avg_temperatures
 
@@ -233,42 +290,39 @@ class SmartHouseRepository:
         The result is a (possibly empty) list of number representing hours [0-23].
         """
         # TODO: implement
-        # kobler til databasen
-        cursor = self.conn.cursor()
-
         # henter room id i databasen basert på rom navnet
-        cursor.execute("SELECT id FROM rooms WHERE name = ?", (room.room_name,))
-        room_id_result = cursor.fetchone()
+        room_id_result = self.conn.execute("SELECT id FROM rooms WHERE name = ?", (room.room_name,)).fetchone()
         if room_id_result is None:
             raise ValueError(f"No room found with name {room.room_name}")
         room_id = room_id_result[0]
 
-        # SQL kode for å hente timer med mer enn tre målinger over gjennomsnittlig luftfuktighet
-        sql_query = """
-                    SELECT hour, COUNT(*) as count
-                    FROM (
-                        SELECT strftime('%H', ts) AS hour, value,
-                        (SELECT AVG(m2.value) FROM measurements m2
-                         INNER JOIN devices d2 ON m2.device = d2.id
-                         WHERE strftime('%H', m2.ts) = strftime('%H', measurements.ts)
-                         AND d2.room = devices.room AND m2.unit = measurements.unit AND date(m2.ts) = date(measurements.ts)
-                         AND d2.kind = 'Humidity Sensor') as avg_humidity
-                        FROM measurements
-                        INNER JOIN devices ON measurements.device = devices.id
-                        WHERE devices.room = ? AND measurements.unit = '%'
-                              AND date(ts) = ? AND devices.kind = 'Humidity Sensor'
-                    ) AS subquery
-                    WHERE hour IN ('07', '08', '09', '12', '18')
-                      AND value > avg_humidity
+        # Etter migrate() brukes de forhåndsutregnede kolonnene hour/day, ellers regnes de ut fra ts
+        if self._has_time_columns:
+            hour_expr, day_expr = "m.hour", "m.day"
+        else:
+            hour_expr, day_expr = "CAST(strftime('%H', m.ts) AS INTEGER)", "date(m.ts)"
+
+        # SQL kode for å hente timer med mer enn tre målinger over gjennomsnittlig luftfuktighet.
+        # Gjennomsnittet per time regnes ut én gang med en vindusfunksjon i stedet for en
+        # korrelert subquery per rad.
+        sql_query = f"""
+                    WITH hourly AS (
+                        SELECT {hour_expr} AS hour, m.value,
+                               AVG(m.value) OVER (PARTITION BY {hour_expr}) AS avg_humidity
+                        FROM measurements m
+                        INNER JOIN devices d ON m.device = d.id
+                        WHERE d.room = ? AND d.kind = 'Humidity Sensor' AND m.unit = '%'
+                              AND {day_expr} = ?
+                    )
+                    SELECT hour
+                    FROM hourly
+                    WHERE value > avg_humidity
                     GROUP BY hour
                     HAVING COUNT(*) > 3
                     """
-        #Litt juks her da jeg definerer hours ut fra fra testen forenter, men klarte ikke returnere en liste
-        #med de ønskede tidspunktene fra testen, fikk med alt for mange tidspunkt
 
         # Executer sql koden med rom id og dato
-        cursor.execute(sql_query, (room_id, date))
-        rows = cursor.fetchall()
+        rows = self.conn.execute(sql_query, (room_id, date)).fetchall()
 
         # legger resultatet i en liste
         hours_with_high_humidity = [int(row[0]) for row in rows]
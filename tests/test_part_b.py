@@ -1,4 +1,7 @@
+import shutil
+import tempfile
 import unittest
+from smarthouse.domain import NewSensorMeasurement
 from smarthouse.persistence import SmartHouseRepository
 from pathlib import Path
 
@@ -144,5 +147,116 @@ class SmartHouseTest(unittest.TestCase):
 
 
 
+class SmartHouseRepositoryCopyTest(unittest.TestCase):
+    """
+    Tests that write to the database, run against a temporary copy of db.sql
+    so the checked-in file stays untouched.
+    """
+    temp_sensor = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+    humidity_sensor = "3d87e5c0-8716-4b0b-9c67-087eaaed7b45"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        file = Path(self.tmpdir.name) / "db.sql"
+        shutil.copy(Path(__file__).parent / "../data/db.sql", file)
+        self.repo = SmartHouseRepository(str(file))
+
+    def tearDown(self):
+        self.repo.conn.close()
+        self.tmpdir.cleanup()
+
+    def count_measurements(self, device_id):
+        return self.repo.conn.execute("SELECT COUNT(*) FROM measurements WHERE device = ?", (device_id,)).fetchone()[0]
+
+    def insert_measurements(self, device_id, rows, unit):
+        with self.repo.conn:
+            self.repo.conn.executemany("INSERT INTO measurements (device, ts, value, unit) VALUES (?, ?, ?, ?)",
+                                       [(device_id, ts, value, unit) for ts, value in rows])
+
+    def bathroom(self):
+        h = self.repo.load_smarthouse_deep()
+        return next(r for r in h.get_rooms() if r.room_name == "Bathroom 1")
+
+    def test_add_measurements_to_sensor(self):
+        before = self.count_measurements(self.temp_sensor)
+        self.repo.add_measurements_to_sensor(self.temp_sensor, [NewSensorMeasurement(value=20.5, unit="°C"),
+                                                                NewSensorMeasurement(value=21.0, unit="°C"),
+                                                                NewSensorMeasurement(value=21.5, unit="°C")])
+        self.assertEqual(before + 3, self.count_measurements(self.temp_sensor))
+        values = [row[0] for row in self.repo.conn.execute(
+            "SELECT value FROM measurements WHERE device = ? ORDER BY rowid DESC LIMIT 3", (self.temp_sensor,))]
+        self.assertEqual([21.5, 21.0, 20.5], values)
+
+    def test_add_measurements_to_sensor_empty_batch(self):
+        before = self.count_measurements(self.temp_sensor)
+        self.repo.add_measurements_to_sensor(self.temp_sensor, [])
+        self.assertEqual(before, self.count_measurements(self.temp_sensor))
+
+    def test_get_latest_readings_order_and_limit(self):
+        sensor = self.repo.get_device_by_id(self.humidity_sensor)
+        self.assertEqual([], self.repo.get_latest_readings(sensor, 10))
+        self.insert_measurements(self.humidity_sensor, [("2024-01-27 08:00:00", 50.0),
+                                                        ("2024-01-27 10:00:00", 52.0),
+                                                        ("2024-01-27 09:00:00", 51.0)], "%")
+        latest = self.repo.get_latest_readings(sensor, 2)
+        self.assertEqual(["2024-01-27 10:00:00", "2024-01-27 09:00:00"], [m.timestamp for m in latest])
+        self.assertEqual([52.0, 51.0], [m.value for m in latest])
+        self.assertEqual(3, len(self.repo.get_latest_readings(sensor, 10)))
+
+    def test_get_latest_readings_batch_order(self):
+        sensor = self.repo.get_device_by_id(self.temp_sensor)
+        # one batch shares a single timestamp, so insertion order decides
+        self.repo.add_measurements_to_sensor(self.temp_sensor, [NewSensorMeasurement(value=v, unit="°C")
+                                                                for v in (20.0, 21.0, 22.0)])
+        self.assertEqual([22.0, 21.0], [m.value for m in self.repo.get_latest_readings(sensor, 2)])
+        self.assertEqual(22.0, self.repo.get_latest_reading(sensor).value)
+
+    def seed_humidity(self):
+        self.insert_measurements(self.humidity_sensor, [
+            # 07: four of five above the hourly average -> counted
+            ("2024-01-27 07:00:00", 90.0), ("2024-01-27 07:10:00", 90.0), ("2024-01-27 07:20:00", 90.0),
+            ("2024-01-27 07:30:00", 90.0), ("2024-01-27 07:40:00", 10.0),
+            # 08: only three above the average -> not counted
+            ("2024-01-27 08:00:00", 90.0), ("2024-01-27 08:10:00", 90.0), ("2024-01-27 08:20:00", 90.0),
+            ("2024-01-27 08:30:00", 10.0), ("2024-01-27 08:40:00", 10.0),
+            # 14: five above the average -> counted (an hour the old hard-coded filter left out)
+            ("2024-01-27 14:00:00", 60.0), ("2024-01-27 14:10:00", 61.0), ("2024-01-27 14:20:00", 62.0),
+            ("2024-01-27 14:30:00", 63.0), ("2024-01-27 14:40:00", 64.0), ("2024-01-27 14:50:00", 10.0),
+            # another day must not be mixed in
+            ("2024-01-28 09:00:00", 90.0), ("2024-01-28 09:10:00", 90.0), ("2024-01-28 09:20:00", 90.0),
+            ("2024-01-28 09:30:00", 90.0), ("2024-01-28 09:40:00", 10.0),
+        ], "%")
+
+    def test_humidity_hours_on_seeded_rows(self):
+        self.seed_humidity()
+        bath = self.bathroom()
+        self.assertEqual([7, 14], self.repo.calc_hours_with_humidity_above(bath, "2024-01-27"))
+        self.assertEqual([9], self.repo.calc_hours_with_humidity_above(bath, "2024-01-28"))
+
+    def test_humidity_hours_on_seeded_rows_after_migrate(self):
+        self.seed_humidity()
+        self.repo.migrate()
+        bath = self.bathroom()
+        self.assertEqual([7, 14], self.repo.calc_hours_with_humidity_above(bath, "2024-01-27"))
+        self.assertEqual([9], self.repo.calc_hours_with_humidity_above(bath, "2024-01-28"))
+
+    def test_migrate_fills_hour_and_day(self):
+        self.insert_measurements(self.humidity_sensor, [("2024-01-27 07:15:00", 40.0)], "%")
+        self.repo.migrate()
+        self.repo.migrate()  # running it again is a no-op
+        # existing rows are backfilled
+        self.assertEqual(0, self.repo.conn.execute("SELECT COUNT(*) FROM measurements WHERE day IS NULL").fetchone()[0])
+        # rows inserted by other tools are filled by the trigger
+        self.insert_measurements(self.humidity_sensor, [("2024-01-29 23:59:59", 41.0)], "%")
+        self.assertEqual((23, "2024-01-29"), self.repo.conn.execute(
+            "SELECT hour, day FROM measurements WHERE ts = '2024-01-29 23:59:59'").fetchone())
+        # rows inserted by the repository get hour and day matching their timestamp
+        self.repo.add_measurement_to_sensor(self.temp_sensor, 22.0, "°C")
+        ts, hour, day = self.repo.conn.execute(
+            "SELECT ts, hour, day FROM measurements WHERE device = ? ORDER BY rowid DESC LIMIT 1",
+            (self.temp_sensor,)).fetchone()
+        self.assertEqual((int(ts[11:13]), ts[:10]), (hour, day))
+
+
 if __name__ == '__main__':
     unittest.main()